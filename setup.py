@@ -20,7 +20,7 @@ setup(
     keywords=['Proteins', 'Deep Learning', 'Pytorch', 'TAPE'],
     include_package_data=True,
     install_requires=[
-        'torch>=1.0',
+        'torch>=1.10',
         'tqdm',
         'tensorboardX',
         'scipy',
@@ -33,8 +33,11 @@ setup(
         'console_scripts': [
             'tape-train = tape.main:run_train',
             'tape-train-distributed = tape.main:run_train_distributed',
+            'tape-gridsearch = tape.main:run_gridsearch',
             'tape-eval = tape.main:run_eval',
+            'tape-eval-distributed = tape.main:run_eval_distributed',
             'tape-embed = tape.main:run_embed',
+            'tape-embed-distributed = tape.main:run_embed_distributed',
         ]
     },
     classifiers=[
@@ -272,10 +272,10 @@ class EmbedDataset(Dataset):
         item = self.data[index]
         token_ids = self.tokenizer.encode(item['primary'])
         input_mask = np.ones_like(token_ids)
-        return item['id'], token_ids, input_mask
+        return token_ids, input_mask, item['id']
 
     def collate_fn(self, batch: List[Tuple[Any, ...]]) -> Dict[str, torch.Tensor]:
-        ids, tokens, input_mask = zip(*batch)
+        tokens, input_mask, ids = zip(*batch)
         ids = list(ids)
         tokens = torch.from_numpy(pad_sequences(tokens))
         input_mask = torch.from_numpy(pad_sequences(input_mask))
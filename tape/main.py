@@ -2,18 +2,14 @@ import typing
 import os
 import logging
 import argparse
-import warnings
 import inspect
-
-
-try:
-    import apex  # noqa: F401
-    APEX_FOUND = True
-except ImportError:
-    APEX_FOUND = False
+import functools
+import json
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from .registry import registry
-from . import training
 from . import utils
 
 CallbackList = typing.Sequence[typing.Callable]
@@ -21,8 +17,6 @@ OutputDict = typing.Dict[str, typing.List[typing.Any]]
 
 
 logger = logging.getLogger(__name__)
-warnings.filterwarnings(  # Ignore pytorch warning about loss gathering
-    'ignore', message='Was asked to gather along dimension 0', module='torch.nn.parallel')
 
 
 def create_base_parser() -> argparse.ArgumentParser:
@@ -41,8 +35,14 @@ def create_base_parser() -> argparse.ArgumentParser:
                              'Set by launch script.')
     parser.add_argument('--tokenizer', choices=['iupac', 'unirep'],
                         default='iupac', help='Tokenizes to use on the amino acid sequences')
-    parser.add_argument('--num_workers', default=8, type=int,
+    parser.add_argument('--num_workers', default=min(os.cpu_count() or 1, 8), type=int,
                         help='Number of workers to use for multi-threaded data loading')
+    parser.add_argument('--no_persistent_workers', action='store_false',
+                        dest='persistent_workers',
+                        help='Shut down data loading workers after every pass over the data '
+                             'instead of keeping them alive')
+    parser.add_argument('--prefetch_factor', default=4, type=int,
+                        help='Number of batches loaded in advance by each worker')
     parser.add_argument('--log_level', default=logging.INFO,
                         choices=['DEBUG', 'INFO', 'WARN', 'WARNING', 'ERROR',
                                  logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR],
@@ -67,13 +67,17 @@ def create_train_parser(base_parser: argparse.ArgumentParser) -> argparse.Argume
                         help='Number of training epochs')
     parser.add_argument('--num_log_iter', default=20, type=int,
                         help='Number of training steps per log iteration')
-    parser.add_argument('--fp16', action='store_true', help='Whether to use fp16 weights')
+    parser.add_argument('--amp_dtype', choices=['fp16', 'bf16', 'off'], default='off',
+                        help='Precision to use for mixed precision training')
+    parser.add_argument('--fp16', action='store_const', const='fp16', dest='amp_dtype',
+                        help='Shorthand for --amp_dtype fp16')
+    parser.add_argument('--amp_backend', choices=['native', 'apex'], default='native',
+                        help='Mixed precision implementation. Apex is only kept as a '
+                             'fallback and must be installed separately.')
     parser.add_argument('--warmup_steps', default=10000, type=int,
                         help='Number of learning rate warmup steps')
     parser.add_argument('--gradient_accumulation_steps', default=1, type=int,
                         help='Number of forward passes to make for each backwards pass')
-    parser.add_argument('--loss_scale', default=0, type=int,
-                        help='Loss scaling. Only used during fp16 training.')
     parser.add_argument('--max_grad_norm', default=1.0, type=float,
                         help='Maximum gradient norm')
     parser.add_argument('--exp_name', default=None, type=str,
@@ -112,6 +116,20 @@ def create_eval_parser(base_parser: argparse.ArgumentParser) -> argparse.Argumen
                         nargs='*')
     parser.add_argument('--split', default='test', type=str,
                         help='Which split to run on')
+    parser.add_argument('--weight_dtype', choices=['float32', 'float16'], default='float32',
+                        help='Precision with which to load the pretrained weights. float16 '
+                             'caches a half precision copy of the weights next to the '
+                             'original and runs the model in fp16 on GPU.')
+    parser.add_argument('--quantize', choices=['none', 'dynamic-int8'], default='none',
+                        help='Quantize the linear layers of the model to int8 when running '
+                             'on CPU')
+    parser.add_argument('--max_batch_tokens', default=None, type=int,
+                        help='If set, batches are sized dynamically so that the number of '
+                             'padded tokens in a batch is at most this value (and the number '
+                             'of sequences at most batch_size)')
+    parser.add_argument('--jit', choices=['off', 'script', 'trace'], default='off',
+                        help='Compile the model with TorchScript before running inference. '
+                             'Falls back to tracing if the model cannot be scripted.')
     return parser
 
 
@@ -131,6 +149,23 @@ def create_embed_parser(base_parser: argparse.ArgumentParser) -> argparse.Argume
                         help='If true, saves an embedding at every amino acid position '
                              'in the sequence. Note that this can take a large amount '
                              'of disk space.')
+    parser.add_argument('--weight_dtype', choices=['float32', 'float16'], default='float32',
+                        help='Precision with which to load the pretrained weights. float16 '
+                             'caches a half precision copy of the weights next to the '
+                             'original and runs the model in fp16 on GPU.')
+    parser.add_argument('--quantize', choices=['none', 'dynamic-int8'], default='none',
+                        help='Quantize the linear layers of the model to int8 when running '
+                             'on CPU')
+    parser.add_argument('--max_batch_tokens', default=None, type=int,
+                        help='If set, batches are sized dynamically so that the number of '
+                             'padded tokens in a batch is at most this value (and the number '
+                             'of sequences at most batch_size)')
+    parser.add_argument('--jit', choices=['off', 'script', 'trace'], default='off',
+                        help='Compile the model with TorchScript before running inference. '
+                             'Falls back to tracing if the model cannot be scripted.')
+    parser.add_argument('--embed_dtype', choices=['float32', 'float16'], default='float32',
+                        help='Precision with which to save the embeddings. float16 halves '
+                             'the size of the output file.')
     parser.set_defaults(task='embed')
     return parser
 
@@ -161,6 +196,33 @@ def create_distributed_parser(base_parser: argparse.ArgumentParser) -> argparse.
     return parser
 
 
+def create_gridsearch_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description='Run a grid search over training hyperparameters')
+    parser.add_argument('config_file', type=utils.check_is_file,
+                        help='Json file containing the training arguments. Arguments given '
+                             'as a list of values are searched over.')
+    return parser
+
+
+@functools.lru_cache()
+def _get_arg_names(function: typing.Callable) -> typing.Tuple[str, ...]:
+    # Signatures don't change, so only inspect each function once per process
+    return tuple(inspect.getfullargspec(function).args)
+
+
+def _select_args(function: typing.Callable,
+                 args: argparse.Namespace) -> typing.Dict[str, typing.Any]:
+    """Selects the parsed arguments that the function takes."""
+    arg_dict = vars(args)
+    arg_names = _get_arg_names(function)
+
+    missing = set(arg_names) - arg_dict.keys()
+    if missing:
+        raise RuntimeError(f"Missing arguments: {missing}")
+    return {name: arg_dict[name] for name in arg_names}
+
+
 def run_train(args: typing.Optional[argparse.Namespace] = None, env=None) -> None:
     if env is not None:
         os.environ = env
@@ -175,23 +237,30 @@ def run_train(args: typing.Optional[argparse.Namespace] = None, env=None) -> Non
             f"Invalid gradient_accumulation_steps parameter: "
             f"{args.gradient_accumulation_steps}, should be >= 1")
 
-    if (args.fp16 or args.local_rank != -1) and not APEX_FOUND:
-        raise ImportError(
-            "Please install apex from https://www.github.com/nvidia/apex "
-            "to use distributed and fp16 training.")
+    if args.amp_backend == 'apex' and args.amp_dtype != 'off':
+        try:
+            import apex  # noqa: F401
+        except ImportError:
+            raise ImportError(
+                "Please install apex from https://www.github.com/nvidia/apex "
+                "to use the apex amp backend.")
+        if args.amp_dtype != 'fp16':
+            raise ValueError("The apex amp backend only supports fp16 training")
 
-    arg_dict = vars(args)
-    arg_names = inspect.getfullargspec(training.run_train).args
+    # Imported here so that building the parsers (e.g. for --help) does not pull in
+    # the training stack (tqdm, tensorboardX, wandb, apex)
+    from . import training
 
-    missing = set(arg_names) - set(arg_dict.keys())
-    if missing:
-        raise RuntimeError(f"Missing arguments: {missing}")
-    train_args = {name: arg_dict[name] for name in arg_names}
+    train_args = _select_args(training.run_train, args)
 
     training.run_train(**train_args)
 
 
-def run_eval(args: typing.Optional[argparse.Namespace] = None) -> typing.Dict[str, float]:
+def run_eval(args: typing.Optional[argparse.Namespace] = None,
+             env=None) -> typing.Dict[str, float]:
+    if env is not None:
+        os.environ = env
+
     if args is None:
         base_parser = create_base_parser()
         parser = create_eval_parser(base_parser)
@@ -199,37 +268,28 @@ def run_eval(args: typing.Optional[argparse.Namespace] = None) -> typing.Dict[st
 
     if args.from_pretrained is None:
         raise ValueError("Must specify pretrained model")
-    if args.local_rank != -1:
-        raise ValueError("TAPE does not support distributed validation pass")
 
-    arg_dict = vars(args)
-    arg_names = inspect.getfullargspec(training.run_eval).args
+    from . import training
 
-    missing = set(arg_names) - set(arg_dict.keys())
-    if missing:
-        raise RuntimeError(f"Missing arguments: {missing}")
-    eval_args = {name: arg_dict[name] for name in arg_names}
+    eval_args = _select_args(training.run_eval, args)
 
     return training.run_eval(**eval_args)
 
 
-def run_embed(args: typing.Optional[argparse.Namespace] = None) -> None:
+def run_embed(args: typing.Optional[argparse.Namespace] = None, env=None) -> None:
+    if env is not None:
+        os.environ = env
+
     if args is None:
         base_parser = create_base_parser()
         parser = create_embed_parser(base_parser)
         args = parser.parse_args()
     if args.from_pretrained is None:
         raise ValueError("Must specify pretrained model")
-    if args.local_rank != -1:
-        raise ValueError("TAPE does not support distributed validation pass")
 
-    arg_dict = vars(args)
-    arg_names = inspect.getfullargspec(training.run_embed).args
+    from . import training
 
-    missing = set(arg_names) - set(arg_dict.keys())
-    if missing:
-        raise RuntimeError(f"Missing arguments: {missing}")
-    embed_args = {name: arg_dict[name] for name in arg_names}
+    embed_args = _select_args(training.run_embed, args)
 
     training.run_embed(**embed_args)
 
@@ -252,5 +312,126 @@ def run_train_distributed(args: typing.Optional[argparse.Namespace] = None) -> N
         args.node_rank, args.master_addr, args.master_port)
 
 
+def run_eval_distributed(args: typing.Optional[argparse.Namespace] = None) -> None:
+    """Runs distributed evaluation via multiprocessing.
+    """
+    if args is None:
+        base_parser = create_base_parser()
+        distributed_parser = create_distributed_parser(base_parser)
+        distributed_eval_parser = create_eval_parser(distributed_parser)
+        args = distributed_eval_parser.parse_args()
+
+    utils.launch_process_group(
+        run_eval, args, args.nproc_per_node, args.nnodes,
+        args.node_rank, args.master_addr, args.master_port)
+
+
+def run_embed_distributed(args: typing.Optional[argparse.Namespace] = None) -> None:
+    """Runs distributed embedding via multiprocessing.
+    """
+    if args is None:
+        base_parser = create_base_parser()
+        distributed_parser = create_distributed_parser(base_parser)
+        distributed_embed_parser = create_embed_parser(distributed_parser)
+        args = distributed_embed_parser.parse_args()
+
+    utils.launch_process_group(
+        run_embed, args, args.nproc_per_node, args.nnodes,
+        args.node_rank, args.master_addr, args.master_port)
+
+
+def _expand_grid(
+        config: typing.Dict[str, typing.Any]) -> typing.List[typing.Dict[str, typing.Any]]:
+    grid_keys = [key for key, value in config.items() if isinstance(value, list)]
+    grid_values = itertools.product(*(config[key] for key in grid_keys))
+    return [dict(config, **dict(zip(grid_keys, values))) for values in grid_values]
+
+
+def _config_to_args(config: typing.Dict[str, typing.Any]) -> argparse.Namespace:
+    """Converts a grid point to command line arguments and parses them, so that it gets
+    the same defaults and validation as tape-train-distributed."""
+    config = dict(config)
+    argv = [str(config.pop('model_type')), str(config.pop('task'))]
+    for key, value in config.items():
+        if value is None or value is False:
+            continue
+        argv.append(f'--{key}')
+        if value is not True:
+            argv.append(str(value))
+
+    base_parser = create_base_parser()
+    distributed_parser = create_distributed_parser(base_parser)
+    distributed_train_parser = create_train_parser(distributed_parser)
+    args, unknown = distributed_train_parser.parse_known_args(argv)
+    if unknown:
+        logger.warning(f"Ignoring unknown grid search arguments: {unknown}")
+    return args
+
+
+_gridsearch_slot = 0
+
+
+def _init_gridsearch_worker(slot_queue) -> None:
+    # Each worker process owns a fixed, disjoint set of GPUs for its lifetime
+    global _gridsearch_slot
+    _gridsearch_slot, devices = slot_queue.get()
+    if devices is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = devices
+
+
+def _run_gridsearch_job(args: argparse.Namespace) -> None:
+    # Concurrent jobs need different ports to set up their process groups
+    args.master_port += _gridsearch_slot
+    run_train_distributed(args)
+
+
+def run_gridsearch(args: typing.Optional[argparse.Namespace] = None) -> None:
+    """Runs distributed training for every point in a grid of hyperparameters. Jobs
+    that fit on the machine at the same time (i.e. num_gpus // nproc_per_node) run in
+    parallel, each on its own set of GPUs.
+    """
+    if args is None:
+        parser = create_gridsearch_parser()
+        args = parser.parse_args()
+
+    utils.setup_logging(local_rank=-1)
+
+    with open(args.config_file) as f:
+        config = json.load(f)
+    grid = [_config_to_args(point) for point in _expand_grid(config)]
+
+    import torch
+    visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible_devices is not None:
+        devices = [device for device in visible_devices.split(',') if device]
+    else:
+        devices = [str(device) for device in range(torch.cuda.device_count())]
+    procs_per_job = max(job_args.nproc_per_node for job_args in grid)
+    num_slots = max(1, len(devices) // procs_per_job)
+
+    # Spawn rather than fork the workers, the parent may already have initialized CUDA
+    # to count the devices, which breaks CUDA in forked children
+    mp_context = mp.get_context('spawn')
+    slot_queue = mp_context.Queue()
+    for slot in range(num_slots):
+        slot_devices = devices[slot * procs_per_job:(slot + 1) * procs_per_job]
+        slot_queue.put((slot, ','.join(slot_devices) if slot_devices else None))
+
+    logger.info(f"Running {len(grid)} grid search jobs, {num_slots} at a time")
+    with ProcessPoolExecutor(max_workers=num_slots,
+                             mp_context=mp_context,
+                             initializer=_init_gridsearch_worker,
+                             initargs=(slot_queue,)) as executor:
+        futures = [executor.submit(_run_gridsearch_job, job_args) for job_args in grid]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            # Don't wait for the queued jobs to run before surfacing the error
+            for future in futures:
+                future.cancel()
+            raise
+
+
 if __name__ == '__main__':
     run_train_distributed()
@@ -32,17 +32,14 @@ def spearmanr(target: Sequence[float],
 @registry.register_metric('accuracy')
 def accuracy(target: Union[Sequence[int], Sequence[Sequence[int]]],
              prediction: Union[Sequence[float], Sequence[Sequence[float]]]) -> float:
-    if isinstance(target[0], int):
+    if isinstance(target[0], int) or np.ndim(target[0]) == 0:
         # non-sequence case
         return np.mean(np.asarray(target) == np.asarray(prediction).argmax(-1))
     else:
-        correct = 0
-        total = 0
-        for label, score in zip(target, prediction):
-            label_array = np.asarray(label)
-            pred_array = np.asarray(score).argmax(-1)
-            mask = label_array != -1
-            is_correct = label_array[mask] == pred_array[mask]
-            correct += is_correct.sum()
-            total += is_correct.size
-        return correct / total
+        # Sequences can have different lengths, so concatenate them into one flat array
+        # and compare everything at once
+        label_array = np.concatenate([np.asarray(label).ravel() for label in target])
+        pred_array = np.concatenate(
+            [np.asarray(score).argmax(-1).ravel() for score in prediction])
+        mask = label_array != -1
+        return np.mean(label_array[mask] == pred_array[mask])
@@ -198,7 +198,8 @@ class Registry:
                        model_name: str,
                        task_name: str,
                        config_file: Optional[PathType] = None,
-                       load_dir: Optional[PathType] = None) -> ProteinModel:
+                       load_dir: Optional[PathType] = None,
+                       **kwargs) -> ProteinModel:
         """ Create a TAPE task model, either from scratch or from a pretrained model.
             This is mostly a helper function that evaluates the if statements in a
             sensible order if you pass all three of the arguments.
@@ -207,6 +208,8 @@ class Registry:
             task_name (str): The TAPE task for which to create a model
             config_file (str, optional): A json config file that specifies hyperparameters
             load_dir (str, optional): A save directory for a pretrained model
+            kwargs (optional): Passed on to `from_pretrained` when loading a pretrained
+                model (e.g. `state_dict`)
         Returns:
             model (ProteinModel): A TAPE task model
         """
@@ -214,7 +217,8 @@ class Registry:
         model_cls = task_spec.get_model(model_name)
 
         if load_dir is not None:
-            model = model_cls.from_pretrained(load_dir, num_labels=task_spec.num_labels)
+            model = model_cls.from_pretrained(
+                load_dir, num_labels=task_spec.num_labels, **kwargs)
         else:
             config_class = model_cls.config_class
             if config_file is not None:
@@ -6,12 +6,15 @@ import json
 from pathlib import Path
 import inspect
 import pickle as pkl
+import contextlib
+import warnings
 
 from tqdm import tqdm
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 from .optimization import WarmupLinearSchedule
 
 from . import utils
@@ -37,6 +40,12 @@ MetricsDict = typing.Dict[str, float]
 LossAndMetrics = typing.Tuple[float, MetricsDict]
 OutputDict = typing.Dict[str, typing.Any]
 
+AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+# Only refresh the inference progress bars every few batches, refreshing on every batch
+# is measurable overhead when the forward pass is short
+PROGRESS_BAR_KWARGS = {'mininterval': 0.5, 'miniters': 50, 'smoothing': 0}
+
 
 class ForwardRunner:
 
@@ -44,14 +53,21 @@ class ForwardRunner:
                  model: ProteinModel,
                  device: torch.device = torch.device('cuda:0'),
                  n_gpu: int = 1,
-                 fp16: bool = False,
-                 local_rank: int = -1):
+                 amp_dtype: str = 'off',
+                 local_rank: int = -1,
+                 amp_backend: str = 'native'):
 
         self.model = model
+        # Keep a handle on the unwrapped model so the DataParallel / DDP wrapper
+        # does not need to be unwrapped again every time it is accessed
+        self.base_model = getattr(model, 'module', model)
         self.device = device
         self.n_gpu = n_gpu
-        self.fp16 = fp16
+        self.amp_dtype = amp_dtype
+        self.amp_backend = amp_backend
+        self.fp16 = amp_dtype != 'off'
         self.local_rank = local_rank
+        self._use_apex = self.fp16 and amp_backend == 'apex'
 
         forward_arg_keys = inspect.getfullargspec(model.forward).args
         forward_arg_keys = forward_arg_keys[1:]  # remove self argument
@@ -59,19 +75,58 @@ class ForwardRunner:
         assert 'input_ids' in self._forward_arg_keys
 
     def initialize_distributed_model(self):
-        if self.local_rank != -1:
-            if not self.fp16:
-                self.model = DDP(self.model)
-            else:
-                flat_dist_call([param.data for param in self.model.parameters()],
-                               torch.distributed.broadcast, (0,))
-        elif self.n_gpu > 1:
+        """Wraps the model for multi-gpu inference. Distributed processes run the model
+        unwrapped, there are no gradients to sync and the sampler already shards the data.
+        """
+        if isinstance(self.model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            return
+        if self.local_rank == -1 and self.n_gpu > 1:
             self.model = nn.DataParallel(self.model)
-
-    def forward(self,
-                batch: typing.Dict[str, torch.Tensor],
-                return_outputs: bool = False,
-                no_loss: bool = False):
+            warnings.filterwarnings(  # Ignore pytorch warning about loss gathering
+                'ignore', message='Was asked to gather along dimension 0',
+                module='torch.nn.parallel')
+
+    def autocast(self):
+        """Returns the autocast context for the forward pass. Only used with native amp,
+        apex handles the casting itself once the model is initialized."""
+        if not self.fp16 or self._use_apex:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device.type, dtype=AMP_DTYPES[self.amp_dtype])
+
+    def jit_compile(self, jit: str, loader: DataLoader) -> None:
+        """Compiles the model with TorchScript for inference. Should be called before
+        initialize_distributed_model. If the model cannot be scripted, it is traced
+        on the first batch of the loader instead.
+
+        Args:
+            jit (str): One of 'off', 'script', or 'trace'.
+            loader (DataLoader): The inference loader, only iterated when tracing.
+        """
+        if jit == 'off':
+            return
+        if jit == 'script':
+            try:
+                self.model = torch.jit.script(self.model)
+                return
+            except Exception as e:
+                logger.warning(f"Could not script model, falling back to tracing: "
+                               f"{type(e).__name__}")
+
+        example_batch = self._prepare_batch(next(iter(loader)))
+        # Traced modules take positional inputs, so the batch keys must be the leading
+        # forward args of the model. The traced module can still be called with kwargs.
+        arg_keys = self._forward_arg_keys[:len(example_batch)]
+        if set(arg_keys) != set(example_batch):
+            raise ValueError(
+                f"Cannot trace model: batch keys {list(example_batch)} are not the leading "
+                f"forward arguments of the model {self._forward_arg_keys}")
+        with torch.no_grad():
+            self.model = torch.jit.trace(
+                self.model, tuple(example_batch[name] for name in arg_keys),
+                strict=False, check_trace=False)
+
+    def _prepare_batch(self,
+                       batch: typing.Dict[str, torch.Tensor]) -> typing.Dict[str, torch.Tensor]:
         # Filter out batch items that aren't used in this model
         # Requires that dataset keys match the forward args of the model
         # Useful if some elements of the data are only used by certain models
@@ -81,8 +136,16 @@ class ForwardRunner:
         if self.device.type == 'cuda':
             batch = {name: tensor.cuda(device=self.device, non_blocking=True)
                      for name, tensor in batch.items()}
+        return batch
+
+    def forward(self,
+                batch: typing.Dict[str, torch.Tensor],
+                return_outputs: bool = False,
+                no_loss: bool = False):
+        batch = self._prepare_batch(batch)
 
-        outputs = self.model(**batch)
+        with self.autocast():
+            outputs = self.model(**batch)
 
         if no_loss:
             return outputs
@@ -121,36 +184,61 @@ class BackwardRunner(ForwardRunner):
                  gradient_accumulation_steps: int = 1,
                  device: torch.device = torch.device('cuda:0'),
                  n_gpu: int = 1,
-                 fp16: bool = False,
+                 amp_dtype: str = 'off',
                  local_rank: int = -1,
                  max_grad_norm: float = 1.0,
                  warmup_steps: int = 0,
-                 num_train_optimization_steps: int = 1000000):
+                 num_train_optimization_steps: int = 1000000,
+                 amp_backend: str = 'native'):
 
-        super().__init__(model, device, n_gpu, fp16, local_rank)
+        super().__init__(model, device, n_gpu, amp_dtype, local_rank, amp_backend)
         self.optimizer = optimizer
         self.max_grad_norm = max_grad_norm
         self._global_step = 0
         self._local_rank = local_rank
-        self._overflow_buf = torch.cuda.IntTensor([0])  # type: ignore
         self.gradient_accumulation_steps = gradient_accumulation_steps
-        self._delay_accumulation = fp16 and local_rank != -1
+        self._delay_accumulation = self._use_apex and local_rank != -1
+        if self._use_apex:
+            self._overflow_buf = torch.cuda.IntTensor([0])  # type: ignore
+        # bf16 has the same exponent range as fp32, so only fp16 needs loss scaling.
+        # The scaler is a no-op when disabled.
+        self.scaler = torch.cuda.amp.GradScaler(
+            enabled=amp_dtype == 'fp16' and amp_backend == 'native')
 
         self.scheduler = WarmupLinearSchedule(
             self.optimizer, warmup_steps, num_train_optimization_steps)
 
     def initialize_fp16(self):
-        if self.fp16:
+        if self._use_apex:
             self.model, self.optimizer = amp.initialize(
                 self.model, self.optimizer, opt_level="O2", loss_scale="dynamic",
                 master_weights=True)
             _amp_state.loss_scalers[0]._loss_scale = 2 ** 20
 
+    def initialize_distributed_model(self):
+        if self.local_rank == -1:
+            super().initialize_distributed_model()
+        elif isinstance(self.model, nn.parallel.DistributedDataParallel):
+            return
+        elif self.amp_backend == 'native':
+            # Task models often have parameters that don't contribute to the loss,
+            # e.g. the pooler when training a masked language model
+            device_ids = [self.local_rank] if self.device.type == 'cuda' else None
+            self.model = nn.parallel.DistributedDataParallel(
+                self.model, device_ids=device_ids, find_unused_parameters=True)
+        elif not self.fp16:
+            self.model = DDP(self.model)
+        else:
+            flat_dist_call([param.data for param in self.model.parameters()],
+                           torch.distributed.broadcast, (0,))
+
     def resume_from_checkpoint(self, checkpoint_dir: str) -> int:
         checkpoint = torch.load(
             os.path.join(checkpoint_dir, 'checkpoint.bin'), map_location=self.device)
         self.optimizer.load_state_dict(checkpoint['optimizer'])
-        if self.fp16:
+        if 'scaler' in checkpoint:
+            self.scaler.load_state_dict(checkpoint['scaler'])
+        if self._use_apex:
             self.optimizer._lazy_init_maybe_master_weights()
             self.optimizer._amp_stash.lazy_init_called = True
             self.optimizer.load_state_dict(checkpoint['optimizer'])
@@ -168,13 +256,14 @@ class BackwardRunner(ForwardRunner):
             save_directory.mkdir()
         else:
             assert save_directory.is_dir(), "Save path should be a directory"
-        model_to_save = getattr(self.model, 'module', self.model)
-        model_to_save.save_pretrained(save_directory)
+        self.base_model.save_pretrained(save_directory)
         optimizer_state: typing.Dict[str, typing.Any] = {
             'optimizer': self.optimizer.state_dict(),
             'scheduler': self.scheduler.state_dict(),
             'epoch': epoch_id}
-        if APEX_FOUND:
+        if self.scaler.is_enabled():
+            optimizer_state['scaler'] = self.scaler.state_dict()
+        if self._use_apex:
             optimizer_state['master params'] = list(amp.master_params(self.optimizer))
             try:
                 optimizer_state['amp'] = amp.state_dict()
@@ -185,25 +274,43 @@ class BackwardRunner(ForwardRunner):
     def backward(self, loss) -> None:
         if not self._delay_accumulation:
             loss = loss / self.gradient_accumulation_steps
-        if self.fp16:
+        if self._use_apex:
             with amp.scale_loss(loss, self.optimizer,
                                 delay_overflow_check=self._delay_accumulation) as scaled_loss:
                 scaled_loss.backward()
         else:
-            loss.backward()
+            self.scaler.scale(loss).backward()
+
+    def no_sync(self, sync: bool = False):
+        """Returns a context in which the gradient allreduce is skipped, so that gradients
+        are only reduced once per optimizer step when accumulating. Both the forward and
+        backward pass must be run inside the context. Does nothing if `sync` is True or
+        if the model isn't wrapped in torch's DistributedDataParallel."""
+        if sync or not isinstance(self.model, nn.parallel.DistributedDataParallel):
+            return contextlib.nullcontext()
+        return self.model.no_sync()
 
     def step(self) -> None:
+        # Gradients must be unscaled before clipping so max_grad_norm applies to the true norm
+        self.scaler.unscale_(self.optimizer)
         nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
         if self._local_rank == -1:
             self._step()
-        elif not self.fp16:
+        elif not self._use_apex:
             # TODO: Can you do this allreduce after accumulation also?
             self._step()
         else:
             self._step_distributed_fp16()
 
     def _step(self) -> None:
-        self.optimizer.step()
+        # GradScaler skips the optimizer step if the gradients contain Inf/NaN
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        if self._use_apex:
+            # apex replaces zero_grad with a version that takes no arguments
+            self.optimizer.zero_grad()
+        else:
+            self.optimizer.zero_grad(set_to_none=True)
         if self.scheduler is not None:
             self.scheduler.step()  # type: ignore
         self._global_step += 1
@@ -296,10 +403,12 @@ def run_train_epoch(epoch_id: int,
 
     start_t = timer()
     for step, batch in enumerate(train_loader):
-        loss, metrics = runner.forward(batch)  # type: ignore
-        runner.backward(loss)
+        sync = (step + 1) % gradient_accumulation_steps == 0
+        with runner.no_sync(sync):
+            loss, metrics = runner.forward(batch)  # type: ignore
+            runner.backward(loss)
         accumulator.update(loss, metrics, step=False)
-        if (step + 1) % gradient_accumulation_steps == 0:
+        if sync:
             runner.step()
             viz.log_metrics(accumulator.step(), "train", runner.global_step)
             if runner.global_step % num_log_iter == 0:
@@ -322,13 +431,13 @@ def run_valid_epoch(epoch_id: int,
     num_batches = len(valid_loader)
     accumulator = utils.MetricsAccumulator()
 
-    torch.set_grad_enabled(False)
     runner.eval()
 
-    for batch in tqdm(valid_loader, desc='Running Eval', total=num_batches,
-                      disable=not is_master, leave=False):
-        loss, metrics = runner.forward(batch)  # type: ignore
-        accumulator.update(loss, metrics)
+    with torch.inference_mode():
+        for batch in tqdm(valid_loader, desc='Running Eval', total=num_batches,
+                          disable=not is_master, leave=False, **PROGRESS_BAR_KWARGS):
+            loss, metrics = runner.forward(batch)  # type: ignore
+            accumulator.update(loss, metrics)
 
     # Reduce loss across all processes if multiprocessing
     eval_loss = utils.reduce_scalar(accumulator.final_loss())
@@ -367,18 +476,22 @@ def _get_outputs_to_save(batch, outputs):
 def run_eval_epoch(eval_loader: DataLoader,
                    runner: ForwardRunner,
                    is_master: bool = True) -> typing.List[typing.Dict[str, typing.Any]]:
-    torch.set_grad_enabled(False)
     runner.eval()
 
     save_outputs = []
 
-    for batch in tqdm(eval_loader, desc='Evaluation', total=len(eval_loader),
-                      disable=not is_master):
-        loss, metrics, outputs = runner.forward(batch, return_outputs=True)  # type: ignore
-        predictions = outputs[1].cpu().numpy()
-        targets = batch['targets'].cpu().numpy()
-        for pred, target in zip(predictions, targets):
-            save_outputs.append({'prediction': pred, 'target': target})
+    with torch.inference_mode():
+        for batch in tqdm(eval_loader, desc='Evaluation', total=len(eval_loader),
+                          disable=not is_master, **PROGRESS_BAR_KWARGS):
+            loss, metrics, outputs = runner.forward(batch, return_outputs=True)  # type: ignore
+            predictions = outputs[1].cpu().numpy()
+            targets = batch['targets'].cpu().numpy()
+            batch_outputs = [{'prediction': pred, 'target': target}
+                             for pred, target in zip(predictions, targets)]
+            if 'index' in batch:
+                for output, index in zip(batch_outputs, batch['index'].tolist()):
+                    output['index'] = index
+            save_outputs.extend(batch_outputs)
 
     return save_outputs
 
@@ -389,10 +502,10 @@ def run_train(model_type: str,
               batch_size: int = 1024,
               num_train_epochs: int = 10,
               num_log_iter: int = 20,
-              fp16: bool = False,
+              amp_dtype: str = 'off',
+              amp_backend: str = 'native',
               warmup_steps: int = 10000,
               gradient_accumulation_steps: int = 1,
-              loss_scale: int = 0,
               max_grad_norm: float = 1.0,
               exp_name: typing.Optional[str] = None,
               from_pretrained: typing.Optional[str] = None,
@@ -410,7 +523,9 @@ def run_train(model_type: str,
               debug: bool = False,
               log_level: typing.Union[str, int] = logging.INFO,
               patience: int = -1,
-              resume_from_checkpoint: bool = False) -> None:
+              resume_from_checkpoint: bool = False,
+              persistent_workers: bool = True,
+              prefetch_factor: int = 4) -> None:
 
     # SETUP AND LOGGING CODE #
     input_args = locals()
@@ -432,12 +547,15 @@ def run_train(model_type: str,
 
     train_dataset = utils.setup_dataset(task, data_dir, 'train', tokenizer)
     valid_dataset = utils.setup_dataset(task, data_dir, 'valid', tokenizer)
+    pin_memory = device.type == 'cuda'
     train_loader = utils.setup_loader(
         train_dataset, batch_size, local_rank, n_gpu,
-        gradient_accumulation_steps, num_workers)
+        gradient_accumulation_steps, num_workers, pin_memory,
+        persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
     valid_loader = utils.setup_loader(
         valid_dataset, batch_size, local_rank, n_gpu,
-        gradient_accumulation_steps, num_workers)
+        gradient_accumulation_steps, num_workers, pin_memory,
+        persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
 
     num_train_optimization_steps = utils.get_num_train_optimization_steps(
         train_dataset, batch_size, num_train_epochs)
@@ -454,11 +572,12 @@ def run_train(model_type: str,
         f"device: {device} "
         f"n_gpu: {n_gpu}, "
         f"distributed_training: {local_rank != -1}, "
-        f"16-bits training: {fp16}")
+        f"mixed precision: {amp_dtype} ({amp_backend})")
 
     runner = BackwardRunner(
         model, optimizer, gradient_accumulation_steps, device, n_gpu,
-        fp16, local_rank, max_grad_norm, warmup_steps, num_train_optimization_steps)
+        amp_dtype, local_rank, max_grad_norm, warmup_steps, num_train_optimization_steps,
+        amp_backend)
 
     runner.initialize_fp16()
     if resume_from_checkpoint:
@@ -539,6 +658,109 @@ def run_train(model_type: str,
         logger.log(35, f"Best Val Loss: {best_val_loss}")
 
 
+def _load_fp16_state_dict(
+        from_pretrained: str) -> typing.Optional[typing.Dict[str, torch.Tensor]]:
+    """Loads a float16 copy of the pretrained weights, (re)creating it next to the original
+    weights file if it is missing or older than the weights. Returns None if from_pretrained
+    is not a local directory.
+    """
+    from .models.modeling_utils import WEIGHTS_NAME
+    if not os.path.isdir(from_pretrained):
+        logger.warning("float16 weights are only cached for local model directories")
+        return None
+
+    weights_file = os.path.join(from_pretrained, WEIGHTS_NAME)
+    fp16_weights_file = os.path.join(from_pretrained, 'pytorch_model.fp16.bin')
+    # save_pretrained overwrites the weights during training, which invalidates the cache
+    if not os.path.exists(fp16_weights_file) or \
+            os.path.getmtime(weights_file) > os.path.getmtime(fp16_weights_file):
+        state_dict = torch.load(weights_file, map_location='cpu')
+        state_dict = {name: tensor.half() if tensor.is_floating_point() else tensor
+                      for name, tensor in state_dict.items()}
+        # Write to a temporary file first so concurrent processes never see a partial file
+        tmp_file = f'{fp16_weights_file}.{os.getpid()}.tmp'
+        try:
+            torch.save(state_dict, tmp_file)
+            os.replace(tmp_file, fp16_weights_file)
+            logger.info(f"cached float16 weights to {fp16_weights_file}")
+        except OSError as e:
+            logger.warning(f"Could not cache float16 weights to {fp16_weights_file}: {e}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return state_dict
+
+    try:
+        # Memory map the file rather than reading it all in before copying into the model
+        return torch.load(fp16_weights_file, map_location='cpu', mmap=True)
+    except TypeError:  # mmap requires torch >= 2.1
+        return torch.load(fp16_weights_file, map_location='cpu')
+
+
+class _IndexedDataset(Dataset):
+    """Adds the dataset index of each example to the batch under the key 'index'."""
+
+    def __init__(self, dataset: Dataset):
+        self.dataset = dataset
+
+    def __len__(self) -> int:
+        return len(self.dataset)  # type: ignore
+
+    def __getitem__(self, index: int):
+        return tuple(self.dataset[index]) + (index,)
+
+    def collate_fn(self, batch: typing.List[typing.Tuple[typing.Any, ...]]) -> OutputDict:
+        output = self.dataset.collate_fn([item[:-1] for item in batch])  # type: ignore
+        output['index'] = torch.tensor([item[-1] for item in batch])
+        return output
+
+
+def _stack_if_same_shape(arrays: typing.List[np.ndarray]) -> typing.Union[
+        np.ndarray, typing.List[np.ndarray]]:
+    """Stacks the arrays into a single array if they all have the same shape (e.g.
+    per-protein predictions), otherwise returns the list (e.g. per-residue predictions).
+    """
+    if arrays and all(array.shape == arrays[0].shape for array in arrays):
+        return np.stack(arrays)
+    return arrays
+
+
+def _setup_inference_model(model_type: str,
+                           task: str,
+                           model_config_file: typing.Optional[str],
+                           from_pretrained: str,
+                           device: torch.device,
+                           weight_dtype: str = 'float32',
+                           quantize: str = 'none') -> typing.Tuple[ProteinModel, str]:
+    """Loads a pretrained model for eval / embedding and moves it to the device.
+    Returns the model and the amp_dtype with which to run it."""
+    state_dict = _load_fp16_state_dict(from_pretrained) if weight_dtype == 'float16' else None
+    model = registry.get_task_model(
+        model_type, task, model_config_file, from_pretrained, state_dict=state_dict)
+    model.eval()
+
+    amp_dtype = 'off'
+    if weight_dtype == 'float16' and device.type == 'cuda':
+        # Run under autocast so that e.g. softmax and layernorm are still computed in fp32
+        model = model.half()
+        amp_dtype = 'fp16'
+
+    if quantize == 'dynamic-int8':
+        if device.type == 'cpu':
+            # Linear layers dominate the compute, run them as int8 matmuls. Their outputs
+            # are regular float tensors, so nothing downstream needs to change.
+            # Fold weight norm into the weights, the quantized layers don't support it.
+            # inplace also avoids a deepcopy, which fails on weight normed layers.
+            for module in model.modules():
+                if hasattr(module, 'weight_g'):
+                    nn.utils.remove_weight_norm(module)
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        else:
+            logger.warning("Dynamic int8 quantization is only supported on CPU, ignoring")
+
+    return model.to(device), amp_dtype
+
+
 def run_eval(model_type: str,
              task: str,
              from_pretrained: str,
@@ -552,9 +774,15 @@ def run_eval(model_type: str,
              num_workers: int = 8,
              debug: bool = False,
              metrics: typing.Tuple[str, ...] = (),
-             log_level: typing.Union[str, int] = logging.INFO) -> typing.Dict[str, float]:
+             log_level: typing.Union[str, int] = logging.INFO,
+             jit: str = 'off',
+             local_rank: int = -1,
+             max_batch_tokens: typing.Optional[int] = None,
+             weight_dtype: str = 'float32',
+             quantize: str = 'none',
+             persistent_workers: bool = True,
+             prefetch_factor: int = 4) -> typing.Dict[str, float]:
 
-    local_rank = -1  # TAPE does not support torch.distributed.launch for evaluation
     device, n_gpu, is_master = utils.setup_distributed(local_rank, no_cuda)
     utils.setup_logging(local_rank, save_path=None, log_level=log_level)
     utils.set_random_seeds(seed, n_gpu)
@@ -565,20 +793,35 @@ def run_eval(model_type: str,
         f"device: {device} "
         f"n_gpu: {n_gpu}")
 
-    model = registry.get_task_model(model_type, task, model_config_file, from_pretrained)
-    model = model.to(device)
+    model, amp_dtype = _setup_inference_model(
+        model_type, task, model_config_file, from_pretrained, device, weight_dtype, quantize)
 
-    runner = ForwardRunner(model, device, n_gpu)
-    runner.initialize_distributed_model()
-    valid_dataset = utils.setup_dataset(task, data_dir, split, tokenizer)
+    valid_dataset = _IndexedDataset(utils.setup_dataset(task, data_dir, split, tokenizer))
     valid_loader = utils.setup_loader(
         valid_dataset, batch_size, local_rank, n_gpu,
-        1, num_workers)
+        1, num_workers, device.type == 'cuda', max_batch_tokens,
+        persistent_workers, prefetch_factor)
+
+    runner = ForwardRunner(model, device, n_gpu, amp_dtype, local_rank)
+    runner.eval()
+    runner.jit_compile(jit, valid_loader)
+    runner.initialize_distributed_model()
 
     metric_functions = [registry.get_metric(name) for name in metrics]
     save_outputs = run_eval_epoch(valid_loader, runner, is_master)
-    target = [el['target'] for el in save_outputs]
-    prediction = [el['prediction'] for el in save_outputs]
+    save_outputs = utils.all_gather_list(save_outputs)
+    if not is_master:
+        return {}
+    # DistributedSampler pads the dataset by repeating examples so that every process gets
+    # the same number of them, only count each example once
+    unique_outputs: typing.Dict[int, typing.Dict[str, typing.Any]] = {}
+    for output in save_outputs:
+        unique_outputs.setdefault(output.pop('index'), output)
+    save_outputs = list(unique_outputs.values())
+
+    # Stack once here rather than having every metric convert the lists separately
+    target = _stack_if_same_shape([el['target'] for el in save_outputs])
+    prediction = _stack_if_same_shape([el['prediction'] for el in save_outputs])
 
     metrics_to_save = {name: metric(target, prediction)
                        for name, metric in zip(metrics, metric_functions)}
@@ -601,9 +844,16 @@ def run_embed(model_type: str,
               seed: int = 42,
               tokenizer: str = 'iupac',
               num_workers: int = 8,
-              log_level: typing.Union[str, int] = logging.INFO) -> None:
+              log_level: typing.Union[str, int] = logging.INFO,
+              jit: str = 'off',
+              local_rank: int = -1,
+              max_batch_tokens: typing.Optional[int] = None,
+              embed_dtype: str = 'float32',
+              weight_dtype: str = 'float32',
+              quantize: str = 'none',
+              persistent_workers: bool = True,
+              prefetch_factor: int = 4) -> None:
 
-    local_rank = -1  # TAPE does not support torch.distributed.launch for embedding
     device, n_gpu, is_master = utils.setup_distributed(local_rank, no_cuda)
     utils.setup_logging(local_rank, save_path=None, log_level=log_level)
     utils.set_random_seeds(seed, n_gpu)
@@ -613,37 +863,65 @@ def run_embed(model_type: str,
         f"n_gpu: {n_gpu}")
 
     task_spec = registry.get_task_spec('embed')
-    model = registry.get_task_model(
-        model_type, task_spec.name, model_config_file, from_pretrained)
-    model = model.to(device)
-    runner = ForwardRunner(model, device, n_gpu)
-    runner.initialize_distributed_model()
+    model, amp_dtype = _setup_inference_model(
+        model_type, task_spec.name, model_config_file, from_pretrained, device,
+        weight_dtype, quantize)
+    dataset = task_spec.dataset(data_file, tokenizer=tokenizer)  # type: ignore
+    valid_loader = utils.setup_loader(
+        dataset, batch_size, local_rank, n_gpu, 1, num_workers, device.type == 'cuda',
+        max_batch_tokens, persistent_workers, prefetch_factor)
+
+    runner = ForwardRunner(model, device, n_gpu, amp_dtype, local_rank)
     runner.eval()
-    torch.set_grad_enabled(False)
+    runner.jit_compile(jit, valid_loader)
+    runner.initialize_distributed_model()
 
-    dataset = task_spec.dataset(data_file, tokenizer=tokenizer)  # type: ignore
-    valid_loader = utils.setup_loader(dataset, batch_size, local_rank, n_gpu, 1, num_workers)
+    if not out_file.endswith('.npz'):
+        out_file = out_file + '.npz'
+    if local_rank != -1:
+        # Each process writes its own shard, which the master merges at the end
+        world_size = torch.distributed.get_world_size()
+        shard_files = [f'{out_file[:-4]}_rank{rank}.npz' for rank in range(world_size)]
+        process_out_file = shard_files[torch.distributed.get_rank()]
+    else:
+        process_out_file = out_file
 
-    with utils.IncrementalNPZ(out_file) as npzfile:
-        with utils.wrap_cuda_oom_error(local_rank, batch_size, n_gpu):
-            for batch in tqdm(valid_loader, total=len(valid_loader)):
+    with utils.IncrementalNPZ(process_out_file) as npzfile:
+        with utils.wrap_cuda_oom_error(local_rank, batch_size, n_gpu), torch.inference_mode():
+            for batch in tqdm(utils.prefetch_to_device(valid_loader, device),
+                              total=len(valid_loader), disable=not is_master,
+                              **PROGRESS_BAR_KWARGS):
                 outputs = runner.forward(batch, no_loss=True)
                 ids = batch['ids']
                 sequence_embed = outputs[0]
                 pooled_embed = outputs[1]
-                sequence_lengths = batch['input_mask'].sum(1)
-                sequence_embed = sequence_embed.cpu().numpy()
-                pooled_embed = pooled_embed.cpu().numpy()
+                input_mask = batch['input_mask'].to(sequence_embed.device)
+                sequence_lengths = input_mask.sum(1)
+                if not full_sequence_embed:
+                    # avgpool across the sequence for the whole batch at once, so that only
+                    # the pooled arrays are copied to the host
+                    mask = input_mask.unsqueeze(2).type_as(sequence_embed)
+                    sequence_embed = (sequence_embed * mask).sum(1) / mask.sum(1)
+
+                # Cast before copying to the host, float16 halves the bytes copied and saved
+                sequence_embed = sequence_embed.to(getattr(torch, embed_dtype)).cpu().numpy()
+                pooled_embed = pooled_embed.to(getattr(torch, embed_dtype)).cpu().numpy()
                 sequence_lengths = sequence_lengths.cpu().numpy()
 
                 for seqembed, poolembed, length, protein_id in zip(
                         sequence_embed, pooled_embed, sequence_lengths, ids):
-                    seqembed = seqembed[:length]
                     arrays = {'pooled': poolembed}
                     if not full_sequence_embed:
-                        # avgpool across the sequence
-                        arrays['avg'] = seqembed.mean(0)
+                        arrays['avg'] = seqembed
                     else:
-                        arrays['seq'] = seqembed
+                        arrays['seq'] = seqembed[:length]
                     to_save = {protein_id: arrays}
                     npzfile.savez(**to_save)
+
+    if local_rank != -1:
+        utils.barrier_if_distributed()
+        if is_master:
+            # DistributedSampler pads the dataset, duplicated ids are dropped on merge
+            utils.merge_npz(shard_files, out_file)
+            for shard_file in shard_files:
+                os.remove(shard_file)
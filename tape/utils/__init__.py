@@ -9,8 +9,10 @@ from .utils import get_num_train_optimization_steps  # noqa: F401
 from .utils import set_random_seeds  # noqa: F401
 from .utils import MetricsAccumulator  # noqa: F401
 from .utils import wrap_cuda_oom_error  # noqa: F401
+from .utils import prefetch_to_device  # noqa: F401
 from .utils import write_lmdb  # noqa: F401
 from .utils import IncrementalNPZ  # noqa: F401
+from .utils import merge_npz  # noqa: F401
 
 from .setup_utils import setup_logging  # noqa: F401
 from .setup_utils import setup_optimizer  # noqa: F401
@@ -20,4 +22,5 @@ from .setup_utils import setup_distributed  # noqa: F401
 
 from .distributed_utils import barrier_if_distributed  # noqa: F401
 from .distributed_utils import reduce_scalar  # noqa: F401
+from .distributed_utils import all_gather_list  # noqa: F401
 from .distributed_utils import launch_process_group  # noqa: F401
@@ -26,14 +26,15 @@ class SortedSampler(Sampler):
                  dataset,
                  sort_key: typing.Callable[[int], typing.Any],
                  indices: typing.Optional[typing.Iterable[int]] = None):
-        super().__init__(dataset)
         self.dataset = dataset
         self.sort_key = sort_key
         if indices is None:
-            sort_keys = map(sort_key, dataset)
+            sort_keys = enumerate(map(sort_key, dataset))
         else:
             sort_keys = ((i, sort_key(dataset[i])) for i in indices)
-        self.sorted_indices = [i for i, _ in sorted(sort_keys, key=operator.itemgetter(1))]
+        sorted_keys = sorted(sort_keys, key=operator.itemgetter(1))
+        self.sorted_indices = [i for i, _ in sorted_keys]
+        self.sorted_keys = [key for _, key in sorted_keys]
 
     def __iter__(self):
         return iter(self.sorted_indices)
@@ -62,6 +63,11 @@ class BucketBatchSampler(BatchSampler):
         sort_key (callable, optional): Callable to specify a comparison key for sorting.
         bucket_size_multiplier (int, optional): Buckets are of size
             `batch_size * bucket_size_multiplier`.
+        max_batch_tokens (int, optional): If given, batches have a dynamic size so that
+            `len(batch) * max(sort_key(item) for item in batch) <= max_batch_tokens`, up to
+            a maximum of `batch_size`. Requires `sort_key` to return the sequence length.
+            Short sequences then get large batches and long sequences small ones, which
+            avoids spending compute on padding.
     Example:
         >>> from torch.utils.data.sampler import SequentialSampler
         >>> sampler = SequentialSampler(list(range(10)))
@@ -77,22 +83,56 @@ class BucketBatchSampler(BatchSampler):
                  drop_last,
                  sort_key,
                  dataset,
-                 bucket_size_multiplier=100):
+                 bucket_size_multiplier=100,
+                 max_batch_tokens=None):
         super().__init__(sampler, batch_size, drop_last)
         self.sort_key = sort_key
         self.dataset = dataset
+        self.max_batch_tokens = max_batch_tokens
         self.bucket_sampler = BatchSampler(
             sampler, min(batch_size * bucket_size_multiplier, len(sampler)), False)
+        # With dynamic batch sizes the number of batches depends on the bucketing, so
+        # __len__ plans out the batches of the next epoch and __iter__ consumes them.
+        self._planned_batches = None
 
-    def __iter__(self):
+    def _token_batches(self, sorted_sampler):
+        batches = []
+        batch = []
+        # Keys are increasing, so each new item sets the padded length of the batch
+        for index, length in zip(sorted_sampler.sorted_indices, sorted_sampler.sorted_keys):
+            is_full = len(batch) == self.batch_size
+            is_full |= (len(batch) + 1) * length > self.max_batch_tokens
+            if batch and is_full:
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+        if batch and not self.drop_last:
+            batches.append(batch)
+        return batches
+
+    def _iter_batches(self):
         for bucket in self.bucket_sampler:
             sorted_sampler = SortedSampler(self.dataset, self.sort_key, indices=bucket)
-            for batch in SubsetRandomSampler(
-                    list(BatchSampler(sorted_sampler, self.batch_size, self.drop_last))):
+            if self.max_batch_tokens is None:
+                batches = list(BatchSampler(sorted_sampler, self.batch_size, self.drop_last))
+            else:
+                batches = self._token_batches(sorted_sampler)
+            for batch in SubsetRandomSampler(batches):
                 yield batch
 
+    def __iter__(self):
+        if self._planned_batches is not None:
+            batches, self._planned_batches = self._planned_batches, None
+            yield from batches
+        else:
+            yield from self._iter_batches()
+
     def __len__(self):
-        if self.drop_last:
+        if self.max_batch_tokens is not None:
+            if self._planned_batches is None:
+                self._planned_batches = list(self._iter_batches())
+            return len(self._planned_batches)
+        elif self.drop_last:
             return len(self.sampler) // self.batch_size
         else:
             return math.ceil(len(self.sampler) / self.batch_size)
@@ -21,6 +21,17 @@ def reduce_scalar(scalar: float) -> float:
     return scalar
 
 
+def all_gather_list(items: typing.List[typing.Any]) -> typing.List[typing.Any]:
+    """Concatenates a list of picklable objects across all processes. Returns the list
+    unchanged if not in a distributed context."""
+    if dist.is_available() and dist.is_initialized():
+        gathered: typing.List[typing.List[typing.Any]] = [
+            [] for _ in range(dist.get_world_size())]
+        dist.all_gather_object(gathered, items)
+        items = [item for process_items in gathered for item in process_items]
+    return items
+
+
 def barrier_if_distributed() -> None:
     """Raises a barrier if in a distributed context, otherwise does nothing."""
     if dist.is_available() and dist.is_initialized():
@@ -99,19 +99,32 @@ def setup_loader(dataset: Dataset,
                  local_rank: int,
                  n_gpu: int,
                  gradient_accumulation_steps: int,
-                 num_workers: int) -> DataLoader:
+                 num_workers: int,
+                 pin_memory: bool = False,
+                 max_batch_tokens: typing.Optional[int] = None,
+                 persistent_workers: bool = True,
+                 prefetch_factor: int = 4) -> DataLoader:
     sampler = DistributedSampler(dataset) if local_rank != -1 else RandomSampler(dataset)
     batch_size = get_effective_batch_size(
         batch_size, local_rank, n_gpu, gradient_accumulation_steps) * n_gpu
     # WARNING: this will fail if the primary sequence is not the first thing the dataset returns
     batch_sampler = BucketBatchSampler(
-        sampler, batch_size, False, lambda x: len(x[0]), dataset)
+        sampler, batch_size, False, lambda x: len(x[0]), dataset,
+        max_batch_tokens=max_batch_tokens)
+
+    worker_kwargs: typing.Dict[str, typing.Any] = {}
+    if num_workers > 0:
+        # These options are only valid with worker processes
+        worker_kwargs = {'persistent_workers': persistent_workers,
+                         'prefetch_factor': prefetch_factor}
 
     loader = DataLoader(
         dataset,
         num_workers=num_workers,
         collate_fn=dataset.collate_fn,  # type: ignore
-        batch_sampler=batch_sampler)
+        batch_sampler=batch_sampler,
+        pin_memory=pin_memory,
+        **worker_kwargs)
 
     return loader
 
@@ -245,6 +245,51 @@ class wrap_cuda_oom_error(contextlib.ContextDecorator):
         return False
 
 
+def prefetch_to_device(loader: typing.Iterable[typing.Dict[str, typing.Any]],
+                       device: torch.device) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+    """Iterates over a loader, moving the tensors in each batch to the given device. On
+    cuda, the copy of the next batch is issued on a separate stream before the current
+    batch is returned, so the host to device transfer overlaps with the computation on
+    the current batch. This only helps if the loader returns pinned memory.
+
+    Args:
+        loader (Iterable[Dict[str, Any]]): Iterable of batches, e.g. a DataLoader.
+        device (torch.device): Device to move the batches to.
+    """
+    if device.type != 'cuda':
+        yield from loader
+        return
+
+    copy_stream = torch.cuda.Stream(device=device)
+
+    def start_copy(batch):
+        with torch.cuda.stream(copy_stream):
+            batch = {name: value.to(device, non_blocking=True)
+                     if isinstance(value, torch.Tensor) else value
+                     for name, value in batch.items()}
+            copied = torch.cuda.Event()
+            copied.record(copy_stream)
+        return batch, copied
+
+    def finish_copy(batch, copied):
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_event(copied)
+        for value in batch.values():
+            if isinstance(value, torch.Tensor):
+                # Tell the caching allocator these tensors are used on the current stream
+                value.record_stream(current_stream)
+        return batch
+
+    prefetched = None
+    for batch in loader:
+        next_prefetched = start_copy(batch)
+        if prefetched is not None:
+            yield finish_copy(*prefetched)
+        prefetched = next_prefetched
+    if prefetched is not None:
+        yield finish_copy(*prefetched)
+
+
 def write_lmdb(filename: str, iterable: typing.Iterable, map_size: int = 2 ** 20):
     """Utility for writing a dataset to an LMDB file.
 
@@ -267,10 +312,10 @@ def write_lmdb(filename: str, iterable: typing.Iterable, map_size: int = 2 ** 20
 
 class IncrementalNPZ(object):
     # Modified npz that allows incremental saving, from https://stackoverflow.com/questions/22712292/how-to-use-numpy-savez-in-a-loop-for-save-more-than-one-array  # noqa: E501
+    # Arrays are written directly into the zip archive rather than staged in a temporary
+    # file, so each array is only written to disk once.
     def __init__(self, file):
-        import tempfile
         import zipfile
-        import os
 
         if isinstance(file, str):
             if not file.endswith('.npz'):
@@ -280,11 +325,6 @@ class IncrementalNPZ(object):
 
         zipfile = self.zipfile_factory(file, mode="w", compression=compression)
 
-        # Stage arrays in a temporary file on disk, before writing to zip.
-        fd, tmpfile = tempfile.mkstemp(suffix='-numpy.npy')
-        os.close(fd)
-
-        self.tmpfile = tmpfile
         self.zip = zipfile
         self._i = 0
 
@@ -296,7 +336,6 @@ class IncrementalNPZ(object):
         return zipfile.ZipFile(*args, **kwargs)
 
     def savez(self, *args, **kwds):
-        import os
         import numpy.lib.format as fmt
 
         namedict = kwds
@@ -307,15 +346,10 @@ class IncrementalNPZ(object):
             namedict[key] = val
             self._i += 1
 
-        try:
-            for key, val in namedict.items():
-                fname = key + '.npy'
-                fid = open(self.tmpfile, 'wb')
-                with open(self.tmpfile, 'wb') as fid:
-                    fmt.write_array(fid, np.asanyarray(val), allow_pickle=True)
-                self.zip.write(self.tmpfile, arcname=fname)
-        finally:
-            os.remove(self.tmpfile)
+        for key, val in namedict.items():
+            fname = key + '.npy'
+            with self.zip.open(fname, mode='w', force_zip64=True) as fid:
+                fmt.write_array(fid, np.asanyarray(val), allow_pickle=True)
 
     def close(self):
         self.zip.close()
@@ -325,3 +359,28 @@ class IncrementalNPZ(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
+
+
+def merge_npz(in_files: typing.Sequence[str], out_file: str) -> None:
+    """Merges several npz files into one, e.g. the per-process outputs of a distributed
+    run. Arrays are copied over one at a time, so the full files are never loaded into
+    memory. If a key appears in more than one file, only the first occurrence is kept.
+
+    Args:
+        in_files (Sequence[str]): The npz files to merge.
+        out_file (str): Output filename to write to.
+    """
+    import shutil
+    import zipfile
+
+    seen = set()
+    with zipfile.ZipFile(out_file, mode='w', allowZip64=True) as out_zip:
+        for in_file in in_files:
+            with zipfile.ZipFile(in_file) as in_zip:
+                for info in in_zip.infolist():
+                    if info.filename in seen:
+                        continue
+                    seen.add(info.filename)
+                    with in_zip.open(info) as src, \
+                            out_zip.open(info.filename, mode='w', force_zip64=True) as dst:
+                        shutil.copyfileobj(src, dst)
@@ -0,0 +1,33 @@
+def test_expand_grid():
+    from tape.main import _expand_grid
+
+    config = {'model_type': 'transformer', 'task': 'fluorescence',
+              'learning_rate': [1e-4, 1e-3], 'batch_size': [8, 16, 32], 'debug': True}
+    grid = _expand_grid(config)
+
+    assert len(grid) == 6
+    assert {(point['learning_rate'], point['batch_size']) for point in grid} == \
+        {(lr, bs) for lr in [1e-4, 1e-3] for bs in [8, 16, 32]}
+    for point in grid:
+        assert point['model_type'] == 'transformer' and point['debug'] is True
+    # The config itself is left untouched
+    assert config['batch_size'] == [8, 16, 32]
+
+
+def test_config_to_args(tmp_path):
+    from tape.main import _config_to_args
+
+    args = _config_to_args({
+        'model_type': 'transformer', 'task': 'fluorescence', 'learning_rate': 1e-3,
+        'batch_size': 16, 'debug': True, 'save_freq': None, 'amp_dtype': 'bf16',
+        'nproc_per_node': 2, 'data_dir': str(tmp_path), 'not_an_argument': 1})
+
+    assert args.model_type == 'transformer'
+    assert args.task == 'fluorescence'
+    assert args.learning_rate == 1e-3
+    assert args.batch_size == 16
+    assert args.debug is True
+    assert args.save_freq == 1  # None keeps the parser default
+    assert args.amp_dtype == 'bf16'
+    assert args.nproc_per_node == 2
+    assert not hasattr(args, 'not_an_argument')
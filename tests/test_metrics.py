@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def _loop_accuracy(target, prediction):
+    # Reference per-sequence implementation
+    correct = 0
+    total = 0
+    for label, score in zip(target, prediction):
+        label_array = np.asarray(label)
+        pred_array = np.asarray(score).argmax(-1)
+        mask = label_array != -1
+        is_correct = label_array[mask] == pred_array[mask]
+        correct += is_correct.sum()
+        total += is_correct.size
+    return correct / total
+
+
+def test_accuracy_ragged_sequences():
+    from tape.metrics import accuracy
+    from tape.training import _stack_if_same_shape
+
+    rng = np.random.RandomState(0)
+    lengths = [5, 9, 3, 12]
+    target = [rng.randint(-1, 3, size=length) for length in lengths]
+    prediction = [rng.rand(length, 3) for length in lengths]
+
+    # Different lengths are left as lists
+    assert isinstance(_stack_if_same_shape(target), list)
+    assert np.isclose(accuracy(_stack_if_same_shape(target), _stack_if_same_shape(prediction)),
+                      _loop_accuracy(target, prediction))
+
+
+def test_accuracy_stacked_sequences():
+    from tape.metrics import accuracy
+    from tape.training import _stack_if_same_shape
+
+    rng = np.random.RandomState(0)
+    target = [rng.randint(-1, 3, size=7) for _ in range(4)]
+    prediction = [rng.rand(7, 3) for _ in range(4)]
+
+    stacked_target = _stack_if_same_shape(target)
+    assert isinstance(stacked_target, np.ndarray) and stacked_target.shape == (4, 7)
+    assert np.isclose(accuracy(stacked_target, _stack_if_same_shape(prediction)),
+                      _loop_accuracy(target, prediction))
+
+
+def test_accuracy_per_protein():
+    from tape.metrics import accuracy
+    from tape.training import _stack_if_same_shape
+
+    target = [np.array(label) for label in [0, 2, 1, 1]]  # 0-d arrays from the eval loop
+    prediction = [np.eye(3)[label] for label in [0, 2, 0, 1]]
+
+    assert accuracy(_stack_if_same_shape(target), _stack_if_same_shape(prediction)) == 0.75
+    assert accuracy([0, 2, 1, 1], prediction) == 0.75
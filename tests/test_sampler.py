@@ -0,0 +1,58 @@
+def _lengths():
+    import random
+    rng = random.Random(0)
+    return [rng.randint(1, 60) for _ in range(500)] + [300]  # one oversized item
+
+
+def _sampler(lengths, max_batch_tokens=None, drop_last=False):
+    from torch.utils.data import RandomSampler
+    from tape.utils._sampler import BucketBatchSampler
+
+    dataset = [[0] * length for length in lengths]
+    return BucketBatchSampler(
+        RandomSampler(dataset), 32, drop_last, len, dataset,
+        bucket_size_multiplier=4, max_batch_tokens=max_batch_tokens)
+
+
+def test_token_batches_respect_budget():
+    lengths = _lengths()
+    batches = list(_sampler(lengths, max_batch_tokens=256))
+
+    for batch in batches:
+        assert len(batch) <= 32
+        if len(batch) > 1:
+            assert len(batch) * max(lengths[i] for i in batch) <= 256
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+
+
+def test_len_matches_yielded_batches():
+    lengths = _lengths()
+    for max_batch_tokens in (None, 256):
+        for drop_last in (False, True):
+            sampler = _sampler(lengths, max_batch_tokens, drop_last)
+            for _ in range(2):
+                num_batches = len(sampler)
+                assert num_batches == len(list(sampler))
+
+
+def test_loader_len_matches_yielded_batches():
+    import torch
+    from torch.utils.data import Dataset
+    from tape.utils import setup_loader
+
+    class LengthDataset(Dataset):
+
+        def __init__(self, lengths):
+            self.lengths = lengths
+
+        def __len__(self):
+            return len(self.lengths)
+
+        def __getitem__(self, index):
+            return ([0] * self.lengths[index],)
+
+        def collate_fn(self, batch):
+            return {'size': torch.tensor(len(batch))}
+
+    loader = setup_loader(LengthDataset(_lengths()), 32, -1, 1, 1, 0, max_batch_tokens=256)
+    assert len(loader) == len(list(loader))
@@ -0,0 +1,44 @@
+import socket
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_ddp_masked_lm_steps():
+    import torch
+    import torch.distributed as dist
+    from tape import ProteinBertForMaskedLM, ProteinBertConfig
+    from tape.training import BackwardRunner
+    from tape.utils import setup_optimizer
+
+    dist.init_process_group(
+        'gloo', init_method=f'tcp://127.0.0.1:{_free_port()}', rank=0, world_size=1)
+    try:
+        config = ProteinBertConfig(
+            hidden_size=12, intermediate_size=12 * 4, num_hidden_layers=2,
+            num_attention_heads=2)
+        model = ProteinBertForMaskedLM(config)
+        optimizer = setup_optimizer(model, 1e-4)
+        runner = BackwardRunner(
+            model, optimizer, device=torch.device('cpu'), local_rank=0)
+        runner.initialize_distributed_model()
+        runner.train()
+
+        input_ids = torch.randint(4, 25, (2, 10))
+        targets = torch.full_like(input_ids, -1)
+        targets[:, 3] = input_ids[:, 3]
+        batch = {'input_ids': input_ids,
+                 'input_mask': torch.ones_like(input_ids),
+                 'targets': targets}
+
+        # The pooler never receives a gradient, which must not break the second step
+        for _ in range(2):
+            loss, _ = runner.forward(batch)
+            runner.backward(loss)
+            runner.step()
+        assert runner.global_step == 2
+    finally:
+        dist.destroy_process_group()
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+def _write_npz(filename, ids):
+    from tape.utils import IncrementalNPZ
+
+    with IncrementalNPZ(filename) as npzfile:
+        for protein_id in ids:
+            npzfile.savez(**{protein_id: {'pooled': np.full(4, int(protein_id[1:]), 'f4')}})
+
+
+def test_merge_npz_drops_duplicates(tmp_path):
+    from tape.utils import merge_npz
+
+    # DistributedSampler pads by repeating examples, here p0 and p1
+    shards = [str(tmp_path / 'out_rank0.npz'), str(tmp_path / 'out_rank1.npz')]
+    _write_npz(shards[0], ['p0', 'p2', 'p4', 'p1'])
+    _write_npz(shards[1], ['p1', 'p3', 'p0'])
+
+    out_file = str(tmp_path / 'out.npz')
+    merge_npz(shards, out_file)
+
+    merged = np.load(out_file, allow_pickle=True)
+    assert sorted(merged.files) == ['p0', 'p1', 'p2', 'p3', 'p4']
+    for protein_id in merged.files:
+        assert (merged[protein_id].item()['pooled'] == int(protein_id[1:])).all()
+
+
+def test_incremental_npz_round_trip(tmp_path):
+    from tape.utils import IncrementalNPZ
+
+    rng = np.random.RandomState(0)
+    arrays = {'p0': {'pooled': rng.rand(4).astype('f4'), 'seq': rng.rand(7, 4).astype('f2')},
+              'p1': rng.rand(3, 2)}
+
+    filename = str(tmp_path / 'embed')
+    with IncrementalNPZ(filename) as npzfile:
+        for protein_id, value in arrays.items():
+            npzfile.savez(**{protein_id: value})
+        npzfile.savez(rng.rand(2))
+
+    loaded = np.load(filename + '.npz', allow_pickle=True)
+    assert sorted(loaded.files) == ['arr_0', 'p0', 'p1']
+    for key, value in arrays['p0'].items():
+        assert loaded['p0'].item()[key].dtype == value.dtype
+        assert (loaded['p0'].item()[key] == value).all()
+    assert (loaded['p1'] == arrays['p1']).all()
+    assert loaded['arr_0'].shape == (2,)